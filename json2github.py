@@ -35,33 +35,117 @@
 # 4. Run the migration script and check all the warnings:
 # ./json2github.py -j issues.json -c ./comments/ -i 0 -o owner -r repo -t $GITHUB_TOKEN
 #
+#    For large exports, the validate command checks all the issues offline
+#    (unconverted fields, missing comments files, unknown references, too
+#    long bodies...) in parallel processes and summarizes the warnings:
+# ./json2github.py validate -j issues.json -c ./comments/ -i 0
+#
 # 5. Run the migration script again and force the updates:
 # ./json2github.py -j issues.json -c ./comments/ -i 0 -o owner -r repo -t $GITHUB_TOKEN -f
 #
+#    For unattended runs (e.g. batch jobs), -y confirms the updates and the
+#    skipping of the issues already imported, without the 5 seconds delays.
+#
+#    Transient and rate-limit errors are retried (-x <max retries>), and the
+#    issues rejected by the import API are repaired (see payload_repairs).
+#    With -g, the source numbers are kept: a closed placeholder is imported
+#    for each pull request (or missing issue), shifted by -i. Consecutive
+#    placeholders are queued by batches of 20 (-b) before waiting for them.
+#    With -k, an issue that still cannot be imported is replaced by a closed
+#    placeholder and recorded in json2github.failed, instead of aborting.
+#
+# 6. Check the imported issues (title, body, labels, state, comments count):
+# ./json2github.py verify -j issues.json -c ./comments/ -i 0 -o owner -r repo -t $GITHUB_TOKEN
+#    (the verification can be interrupted and resumed, see json2github.verify;
+#    a resumed verification only converts the issues not checked yet, and
+#    lists the pages after the last one completed, unless issues were
+#    added or deleted on GitHub in the meantime)
+#
+# 7. Rewrite the links to the comments of the source repo
+#    (https://github.com/src_user/src_repo/issues/1#issuecomment-241012450):
+#    first index the imported comments (in json2github.comments), then edit
+#    the issues and comments containing such links:
+# ./json2github.py index -c ./comments/ -o owner -r repo -t $GITHUB_TOKEN
+# ./json2github.py relink -p src_user/src_repo -o owner -r repo -t $GITHUB_TOKEN -f
+#
+# The conversion can also be done offline (without token), and the
+# resulting import payloads uploaded later, possibly from another machine:
+# ./json2github.py convert -j issues.json -c ./comments/ -i 0 -o owner -P issues.ndjson
+# ./json2github.py upload -P issues.ndjson -o owner -r repo -t $GITHUB_TOKEN -f
+#
+# The issues JSON file and the comments files can be compressed (.gz, .bz2
+# or .xz, e.g. issues.json.xz and comments/1.json.gz), they are decompressed
+# on the fly. With -z gz (or bz2, xz), the payload file and the log are
+# written compressed (json2github.log.gz, etc.); pass the same -z option to
+# every run, so that the log is found again.
+#
+# If json2github.log was lost, it can be rebuilt from the "Original issue"
+# lines of the imported issues (use the same -p option as for the import):
+# ./json2github.py recover -p src_user/src_repo -o owner -r repo -t $GITHUB_TOKEN
+#
+# The attachments and images linked from the issues (see asset_url_patterns)
+# can be mirrored while converting: they are downloaded in ./assets/ and
+# the links are rewritten to point to the URL where this folder is
+# published, e.g. with -a https://owner.github.io/repo-assets
+# The downloaded URLs are recorded in ./assets/json2github.assets, so that
+# the next runs (e.g. verify with the same -a option) reuse the files.
+#
+# To find out where the time and memory go, each phase can be profiled:
+# -C ./profiles/ writes the cProfile stats of each phase (and of one issue
+# conversion out of -S <N>), -M 1 reports the top allocations and the peak
+# memory of each phase (tracing more frames is more costly).
+#
+# On large repos, the read-only API calls (issues/labels/users checks,
+# verification) can be spread over the tokens of other accounts, e.g.:
+# ./json2github.py verify ... -t $GITHUB_TOKEN -T $TOKEN_2,$TOKEN_3
+# The import requests are always sent with the -t token.
+#
 # The script depends on the requests package.
 # You can get the right environment by running:
 # $ sudo pip3 install --upgrade pip && sudo pip3 install requests
 
 import csv
 import getopt
+import hashlib
+import importlib
 import json
 import os
+import queue
 import re
-import requests
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
 
 github_url = "https://api.github.com"
 src_issues = []
+# source number -> destination number
+src_index = {}
 
 # Default values
+command = "import"
+assume_yes = False
 src_prefix_issues = ""
 force_update = False
 json_file = ""
 comments_path = ""
+payload_file = "json2github.ndjson"
+import_log = "json2github.log"
+# The input files (issues, comments) can be compressed, e.g. comments/1.json.gz
+# With -z <ext>, the payload file and the import log are compressed too
+compressed_exts = {".gz": "gzip", ".bz2": "bz2", ".xz": "lzma"}
+compress_ext = ""
 github_owner = ""
 github_repo = ""
 github_token = ""
+# extra tokens (from other accounts) only used for read-only API calls,
+# the imported issues are always posted with github_token
+github_read_tokens = []
+convert_workers = 4
+validate_workers = os.cpu_count() or 1
 existing_issues = 0
 # existing issues <=> issue numbers already taken in GitHub dest repo.
 # this info is provided by CLI arg (the script can find this by itself
@@ -74,6 +158,94 @@ labels_to_add = []
 # Feel free to modify this
 debug = False
 
+# Max number of converted issues waiting to be imported
+queue_size = 16
+
+# Profiling: with -C <folder>, each phase of main is profiled with cProfile,
+# along with one issue conversion out of profile_sampling (-S);
+# with -M <frames>, the memory allocations of each phase are reported
+profile_dir = ""
+profile_sampling = 100
+trace_frames = 0
+# Since Python 3.12, a profiler records all the threads and only one can be
+# active at a time: the phases running conversions are not profiled, and
+# the sampled conversions are profiled one at a time
+profiler_exclusive = sys.version_info >= (3, 12)
+
+# With -g, the source numbers are kept by importing placeholders for the
+# pull requests; consecutive placeholders are imported by batches
+preserve_numbers = False
+placeholders_batch = 20
+
+# Import errors handling: transient and rate-limit errors are retried
+# max_retries times, rejected payloads are repaired (see payload_repair)
+max_retries = 5
+# Max delay between two checks of an import status, and number of checks
+# of whether an issue was created despite a transient error
+max_poll_wait = 60
+created_checks = 5
+payload_repairs = ["body", "comments", "assignee"]
+max_body_length = 65536
+max_comments = 2500
+# With -k, an issue that cannot be imported is replaced by a placeholder
+keep_going = False
+failed_log = "json2github.failed"
+
+# Asset mirroring, enabled with -a <base URL>: the files linked with
+# these URLs are downloaded in asset_store (one file per distinct content)
+# and the links are rewritten to point to <base URL>/<path in asset_store>
+# (the patterns must not contain capturing groups)
+asset_base_url = ""
+asset_store = "assets"
+asset_workers = 8
+asset_url_patterns = [
+    r"https://coq\.inria\.fr/bugfiles/attachment\.cgi\?id=\d+",
+    r"https://user-images\.githubusercontent\.com/[\w./-]+",
+    r"https://github\.com/[\w.-]+/[\w.-]+/(?:files|assets)/[\w./-]+",
+]
+# Stripped from the end of the matched URLs (e.g. the end of a sentence)
+asset_url_trailing = ".,;:!?)"
+# URL, path of the downloaded files, in asset_store
+asset_map = "json2github.assets"
+
+verify_log = "json2github.verify"
+
+# Index of the imported comments, see github_comments_index()
+comments_index = "json2github.comments"
+
+# Read-only API calls are spread over all the tokens, see token_acquire()
+token_pool = []
+token_lock = threading.Lock()
+
+# Profiles of the sampled conversions (one per worker thread, merged when
+# saved), see bug_convert_sampled()
+convert_profilers = []
+convert_profiler_local = threading.local()
+profile_count = 0
+profile_due = 0
+profile_active = False
+profile_samples = 0
+profile_lock = threading.Lock()
+
+# Warnings of the validate command, see warning()
+warnings_report = None
+# The warnings are printed by the conversion threads
+warning_lock = threading.Lock()
+comment_files = None
+
+# Links used by subst_issuecomment()
+comment_links = {}
+issue_links = {}
+
+# Downloads of the mirrored assets, see assets_mirror()
+asset_downloads = {}
+asset_paths = set()
+asset_lock = threading.Lock()
+asset_executor = None
+asset_known = None
+asset_stats = {"links": 0, "files": 0, "duplicates": 0, "failures": 0,
+               "bytes": 0, "start": None, "end": None}
+
 issue_unused_fields = [
     "url",
     "repository_url",
@@ -101,38 +273,80 @@ issue_unused_fields = [
 
 def usage():
     print("Issues JSON file to GitHub Issues Uploader")
-    print("Usage: \t%s [-h] [-f]\n"
+    print("Usage: \t%s [import|verify|convert|upload|recover|index|relink|\n"
+          "\tvalidate]\n"
+          "\t[-h] [-f] [-y] [-k]\n"
+          "\t[-g] (keep the numbers of the source issues) [-b <batch size>]\n"
           "\t[-j <src JSON file>] [-c <comments folder path>]\n"
+          "\t[-P <payload file>] (for convert/upload, default: %s)\n"
           "\t[-p <src-user/src-repo>] (optional, if you want backlinks)\n"
           "\t[-i <existing issues>]\n"
           "\t[-o <dst GitHub owner>] [-r <dst repo>] [-t <dst access token>]\n"
-          % os.path.basename(__file__))
+          "\t[-T <read-only token>[,<read-only token>...]] (optional)\n"
+          "\t[-w <conversion threads>] (default: %d)\n"
+          "\t[-n <validation processes>] (default: %d)\n"
+          "\t[-x <max retries>] (default: %d)\n"
+          "\t[-k] (import a placeholder for the issues that cannot be imported)\n"
+          "\t[-a <assets base URL>] [-A <assets folder>] (default: %s)\n"
+          "\t[-z gz|bz2|xz] (compress the payload file and the log)\n"
+          "\t[-C <profiles folder>] [-S <profile 1 conversion out of N>]"
+          " (default: %d)\n"
+          "\t[-M <traced frames>] (report the memory allocations)\n"
+          % (os.path.basename(__file__), payload_file, convert_workers,
+             validate_workers, max_retries, asset_store, profile_sampling))
     print("Example:")
     print("\t%s -h" % os.path.basename(__file__))
     print("\t%s -j issues.json -c ./comments/ -p src_user/src_repo \\\n"
           "\t\t-i 0 -o dst_login -r dst_repo -t dst_token"
           % os.path.basename(__file__))
+    print("\t%s verify -j issues.json -c ./comments/ -i 0 \\\n"
+          "\t\t-o dst_login -r dst_repo -t dst_token"
+          % os.path.basename(__file__))
+    print("\t%s validate -j issues.json -c ./comments/"
+          % os.path.basename(__file__))
+    print("\t%s convert -j issues.json -c ./comments/ -i 0 -o dst_login \\\n"
+          "\t\t-P issues.ndjson"
+          % os.path.basename(__file__))
+    print("\t%s upload -P issues.ndjson -o dst_login -r dst_repo -t dst_token"
+          % os.path.basename(__file__))
+    print("\t%s recover -p src_user/src_repo -o dst_login -r dst_repo -t dst_token"
+          % os.path.basename(__file__))
+    print("\t%s index -c ./comments/ -o dst_login -r dst_repo -t dst_token"
+          % os.path.basename(__file__))
+    print("\t%s relink -p src_user/src_repo \\\n"
+          "\t\t-o dst_login -r dst_repo -t dst_token -f"
+          % os.path.basename(__file__))
     exit(1)
 
 
+def open_any(filename, mode):
+    # Open a file, compressed according to its extension (.gz, .bz2, .xz)
+    ext = os.path.splitext(filename)[1]
+    if ext in compressed_exts:
+        module = importlib.import_module(compressed_exts[ext])
+        if "b" not in mode:
+            return module.open(filename, mode + "t", encoding="utf-8")
+        return module.open(filename, mode)
+    if "b" in mode:
+        return open(filename, mode)
+    return open(filename, mode, encoding="utf-8")
+
+
 def is_strictly_sorted(l):
     return all(l[i] < l[i+1] for i in range(len(l)-1))
 
 
 def id_convert(inp):
     id = int(inp)
+    # With -g, the gaps are filled with placeholders (see gaps_fill)
+    if preserve_numbers and 1 <= id <= src_issues[-1]:
+        return existing_issues + id
     # Assume is_strictly_sorted(src_issues) and src_issues[0] >= 1
-    if id not in src_issues:
-        print("WARNING: %d doesn't belong in %s" % (id, src_issues))
+    if id not in src_index:
+        warning("unknown reference", id,
+                "WARNING: %d doesn't belong in %s", id, src_issues)
         return 0  # dummy value
-    already_imported = 0
-    for cur in src_issues:
-        if id == cur:
-            return existing_issues + already_imported + 1
-        else:
-            already_imported += 1
-    print("ERROR: In id_convert(%d): unexpected error" % id)
-    exit(2)
+    return src_index[id]
 
 
 def strid_convert_from_match(match):
@@ -153,11 +367,259 @@ def subst_comment_id(body):
 # print(subst_comment_id(body))
 # exit(0)
 
-# def subst_issuecomment(body):
-#     global src_prefix_issues
-#     # https://github.com/psteckler/ProofGeneral/issues/1#issuecomment-241012450
-#     # ===> https://github.com/ProofGeneral/PG/issues/238
-#     return body
+def issuecomment_convert_from_match(match):
+    # Look for the comment in the index built by the index command,
+    # otherwise link to the imported issue
+    link = comment_links.get(match.group(2))
+    if link is not None:
+        number, comment_id = link.decode().split()
+        return ("https://github.com/%s/%s/issues/%s#issuecomment-%s"
+                % (github_owner, github_repo, number, comment_id))
+    number = issue_links.get(int(match.group(1)))
+    if number is not None:
+        return ("https://github.com/%s/%s/issues/%d"
+                % (github_owner, github_repo, number))
+    return match.group(0)
+
+
+def subst_issuecomment(body):
+    # https://github.com/psteckler/ProofGeneral/issues/1#issuecomment-241012450
+    # ===> https://github.com/ProofGeneral/PG/issues/238#issuecomment-...
+    return re.sub(r"https://github\.com/%s/(?:issues|pull)/(\d+)"
+                  r"#issuecomment-(\d+)" % re.escape(src_prefix_issues),
+                  issuecomment_convert_from_match, body or "")
+
+
+def asset_download(url):
+    # Return the path of the downloaded file relatively to asset_store
+    import requests
+    try:
+        r = requests.get(url, timeout=60)
+    except requests.exceptions.RequestException as e:
+        r = None
+        error = str(e)
+    if r is None or not r:
+        if r is not None:
+            error = "HTTP %d" % r.status_code
+        print("WARNING: cannot download %s (%s), keeping the link"
+              % (url, error))
+        with asset_lock:
+            asset_stats["failures"] += 1
+        return None
+    digest = hashlib.sha256(r.content).hexdigest()
+    ext = os.path.splitext(urlparse(url).path)[1]
+    if not re.match(r"^\.\w{1,5}$", ext) or ext == ".cgi":
+        ext = ""
+    path = "%s/%s%s" % (digest[:2], digest, ext)
+    filename = os.path.join(asset_store, path)
+    with asset_lock:
+        duplicate = path in asset_paths or os.path.exists(filename)
+        asset_paths.add(path)
+        if duplicate:
+            asset_stats["duplicates"] += 1
+        else:
+            asset_stats["files"] += 1
+            asset_stats["bytes"] += len(r.content)
+        asset_stats["end"] = time.time()
+    if not duplicate:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename + ".tmp", "wb") as f:
+            f.write(r.content)
+        os.replace(filename + ".tmp", filename)
+    with asset_lock:
+        with open(os.path.join(asset_store, asset_map), "a") as f:
+            csv.writer(f).writerow([url, path])
+    return path
+
+
+def assets_known():
+    # Return the URLs downloaded by the previous runs, see asset_map
+    ret = {}
+    try:
+        with open(os.path.join(asset_store, asset_map), "r") as f:
+            for row in csv.reader(f):
+                if len(row) == 2 and \
+                   os.path.exists(os.path.join(asset_store, row[1])):
+                    ret[row[0]] = row[1]
+    except IOError:
+        pass
+    return ret
+
+
+def asset_link_convert(match, paths):
+    url = match.group(0).rstrip(asset_url_trailing)
+    return paths.get(url, url) + match.group(0)[len(url):]
+
+
+def assets_mirror(body):
+    global asset_executor, asset_known
+    if not asset_base_url or not body:
+        return body
+    urls = set(url.rstrip(asset_url_trailing) for url in
+               re.findall("|".join(asset_url_patterns), body))
+    if not urls:
+        return body
+    with asset_lock:
+        if asset_executor is None:
+            asset_executor = ThreadPoolExecutor(max_workers=asset_workers)
+            asset_known = assets_known()
+            asset_stats["start"] = time.time()
+        for url in urls:
+            asset_stats["links"] += 1
+            if url not in asset_downloads and url not in asset_known:
+                asset_downloads[url] = asset_executor.submit(asset_download,
+                                                             url)
+    paths = {}
+    for url in urls:
+        if url in asset_known:
+            path = asset_known[url]
+        else:
+            path = asset_downloads[url].result()
+        if path:
+            paths[url] = "%s/%s" % (asset_base_url.rstrip("/"), path)
+    # Each link is looked up as a whole, as a URL can be a prefix of another
+    return re.sub("|".join(asset_url_patterns),
+                  lambda match: asset_link_convert(match, paths), body)
+
+
+def assets_report():
+    if not asset_base_url:
+        return
+    elapsed = 0
+    if asset_stats["start"] and asset_stats["end"]:
+        elapsed = asset_stats["end"] - asset_stats["start"]
+    print("===> Assets mirrored in %s:" % asset_store)
+    print("\t%d links, %d distinct URLs downloaded, %d already known"
+          % (asset_stats["links"], len(asset_downloads),
+             len(asset_known or {})))
+    print("\t%d files stored (%d bytes), %d duplicate contents, %d failures"
+          % (asset_stats["files"], asset_stats["bytes"],
+             asset_stats["duplicates"], asset_stats["failures"]))
+    if elapsed > 0:
+        print("\t%.1f seconds, %.1f files/s, %.1f KB/s"
+              % (elapsed,
+                 (asset_stats["files"] + asset_stats["duplicates"]) / elapsed,
+                 asset_stats["bytes"] / 1024 / elapsed))
+
+
+def profile_start():
+    if trace_frames:
+        import tracemalloc
+        tracemalloc.start(trace_frames)
+
+
+@contextmanager
+def profile_phase(name, conversions=False):
+    # Profile a phase of main (-C) and report its memory allocations (-M)
+    if not (profile_dir or trace_frames):
+        yield
+        return
+    import cProfile
+    import tracemalloc
+    start = time.time()
+    if trace_frames:
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+    profiled = profile_dir and not (conversions and profiler_exclusive)
+    if profiled:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiled:
+            profiler.disable()
+        print("===> Phase %s: %.2f seconds" % (name, time.time() - start))
+        if trace_frames:
+            current, peak = tracemalloc.get_traced_memory()
+            print("\tmemory: %.1f MB allocated, %.1f MB peak"
+                  % (current / 2**20, peak / 2**20))
+            ignored = [tracemalloc.Filter(False, tracemalloc.__file__),
+                       tracemalloc.Filter(False, cProfile.__file__)]
+            snapshot = tracemalloc.take_snapshot().filter_traces(ignored)
+            stats = snapshot.compare_to(before.filter_traces(ignored),
+                                        "lineno")
+            for stat in stats[:10]:
+                print("\t%s" % stat)
+        if profiled:
+            profile_save(name, profiler)
+        elif profile_dir:
+            print("\tphase not profiled, to profile the sampled conversions"
+                  " (only one profiler can be active since Python 3.12)")
+
+
+def profile_save(name, *profilers):
+    import pstats
+    filename = os.path.join(profile_dir, name)
+    os.makedirs(profile_dir, exist_ok=True)
+    stats = pstats.Stats(*profilers)
+    stats.dump_stats(filename + ".prof")
+    with open(filename + ".txt", "w") as f:
+        stats.stream = f
+        stats.sort_stats("cumulative").print_stats(50)
+    print("\tprofile written to %s.prof (and .txt)" % filename)
+
+
+def bug_convert_sampled(bug, comments_path):
+    # The conversions run in worker threads, outside of the profile of
+    # the current phase: one out of profile_sampling is profiled apart
+    global profile_count, profile_due, profile_active, profile_samples
+    with profile_lock:
+        profile_count += 1
+        if profile_count % profile_sampling == 0:
+            profile_due += 1
+        # If another sample is running, the next conversion is sampled
+        sampled = profile_due > 0 and not profile_active
+        if sampled:
+            profile_due -= 1
+            profile_active = profiler_exclusive
+    if not sampled:
+        return bug_convert(bug, comments_path)
+    profiler = getattr(convert_profiler_local, "profiler", None)
+    if profiler is None:
+        import cProfile
+        profiler = cProfile.Profile()
+        convert_profiler_local.profiler = profiler
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is active (since Python 3.12)
+        with profile_lock:
+            profile_active = False
+        return bug_convert(bug, comments_path)
+    try:
+        ret = bug_convert(bug, comments_path)
+    finally:
+        profiler.disable()
+    with profile_lock:
+        profile_active = False
+        profile_samples += 1
+        if profiler not in convert_profilers:
+            convert_profilers.append(profiler)
+    return ret
+
+
+def profile_convert_save():
+    if not profile_dir:
+        return
+    if profile_samples:
+        print("===> %d conversions out of %d profiled"
+              % (profile_samples, profile_count))
+        profile_save("bug_convert", *convert_profilers)
+    elif profile_count >= profile_sampling:
+        print("WARNING: no conversion could be profiled")
+
+
+def warning(kind, detail, message, *args):
+    # In the validate command, the warnings are counted instead of printed
+    # (the message is only formatted with its args when printed)
+    if warnings_report is None:
+        if message:
+            with warning_lock:
+                print(message % args if args else message)
+        return
+    details = warnings_report.setdefault(kind, {})
+    details[detail] = details.get(detail, 0) + 1
 
 
 def fields_ignore(obj, fields):
@@ -165,12 +627,6 @@ def fields_ignore(obj, fields):
         obj.pop(field, None)
 
 
-def fields_dump(obj):
-    # Make sure we have converted all the fields
-    for key, val in obj.items():
-        print(" " * 8 + "%s[%d] = %s" % (key, len(val), val))
-
-
 # def fields_filter(obj, fields):
 #     ret = {}
 #     for field in fields:
@@ -195,7 +651,7 @@ def comment_convert(comment):
 
     ret.append("Comment author: @" + login)
     ret.append("")
-    ret.append(subst_comment_id(body))
+    ret.append(assets_mirror(subst_comment_id(body)))
 
     return {"body": "\n".join(ret), "created_at": created_at}
 
@@ -211,8 +667,26 @@ def comments_convert(comments):
     return ret
 
 
+def comments_file(src_number):
+    # Return the (possibly compressed) comments file, or None if missing;
+    # comment_files is the contents of comments_path, if it was scanned
+    filename = comments_path + str(src_number) + ".json"
+    for ext in [""] + list(compressed_exts):
+        if comment_files is None:
+            if os.path.exists(filename + ext):
+                return filename + ext
+        elif str(src_number) + ".json" + ext in comment_files:
+            return filename + ext
+    return None
+
+
 def get_comments_convert(src_number, comments_path):
-    with open(comments_path + str(src_number) + ".json") as json_data:
+    filename = comments_file(src_number)
+    if filename is None and warnings_report is not None:
+        warning("missing comments file", src_number, "")
+        return []
+    with open_any(filename or comments_path + str(src_number) + ".json",
+                  "r") as json_data:
         comments_json = json.load(json_data)
     return comments_convert(comments_json)
 
@@ -257,14 +731,10 @@ def bug_convert(bug, comments_path):
     login = bug.pop("user")["login"]
 
     # Create the bug description
-    if src_prefix_issues:
-        text = "Original issue: %s#%d" % (src_prefix_issues, src_number)
-    else:
-        text = "Original issue number: %d" % src_number
-    ret["body"].append(text)
+    ret["body"].append(src_number_line(src_number))
     ret["body"].append("Opened by: @" + login)
     ret["body"].append("")
-    ret["body"].append(subst_comment_id(bug.pop("body")))
+    ret["body"].append(assets_mirror(subst_comment_id(bug.pop("body"))))
 
     # Put everything together
     ret["body"] = "\n".join(ret["body"])
@@ -272,20 +742,45 @@ def bug_convert(bug, comments_path):
     # Ignore some bug fields
     fields_ignore(bug, issue_unused_fields)
     # Make sure we have converted all the fields
-    if bug:
-        print("WARNING: unconverted bug fields:")
-        fields_dump(bug)
+    for key, val in bug.items():
+        size = len(val) if isinstance(val, (str, list, dict)) else "-"
+        warning("unconverted field", key,
+                "WARNING: unconverted bug field:\n" + " " * 8 + "%s[%s] = %s",
+                key, size, val)
 
     return ret
 
 
-def bugs_convert(src_issues_json, comments_path):
-    global src_issues
+def src_number_line(src_number):
+    # The "Original issue" line, see src_number_extract()
+    if src_prefix_issues:
+        return "Original issue: %s#%d" % (src_prefix_issues, src_number)
+    return "Original issue number: %d" % src_number
+
+
+def src_number_extract(body):
+    # Find the "Original issue" line written by bug_convert
+    if src_prefix_issues:
+        pattern = r"^Original issue: %s#(\d+)$" % re.escape(src_prefix_issues)
+    else:
+        pattern = r"^Original issue(?: number: |: \S*#)(\d+)$"
+    result = re.search(pattern, body or "", re.MULTILINE)
+    if result:
+        return int(result.group(1))
+    return None
+
+
+def bugs_prepare(src_issues_json):
+    global src_issues, src_index
     src_issues = []
+    src_index = {}
+    bugs = []
     for issue in src_issues_json:
         #FIXME/WARN: Don't import pull requests
         if "pull_request" not in issue:
             src_issues.append(issue["number"])
+            src_index[issue["number"]] = existing_issues + len(src_issues)
+            bugs.append(issue)
     if src_issues == []:
         print("WARNING: no issue")
         exit(0)
@@ -295,62 +790,217 @@ def bugs_convert(src_issues_json, comments_path):
         exit(2)
     if debug:
         print("INFO: will import source issues %s" % str(src_issues))
-    new_issues = {}
-    for issue in src_issues_json:
-        #FIXME/WARN: Don't import pull requests
-        if "pull_request" not in issue:
-            new_issue = bug_convert(issue, comments_path)
-            new_id = new_issue.pop("number")
-            new_issues[new_id] = new_issue
-    return new_issues
+    return bugs
 
 
-def github_get(url, avs={}):
+def bugs_preflight(bugs):
+    # The labels and assignees of the issues, as set by bug_convert, so that
+    # they can be checked before the (pipelined) conversion
+    ret = {}
+    for bug in bugs:
+        issue = {"labels": extract_labels(bug["labels"]) + labels_to_add}
+        #FIXME/WARN: We only assign open bug reports
+        if bug["state"] != "closed" and bug.get("assignee"):
+            issue["assignee"] = bug["assignee"]
+        ret[bug["number"]] = issue
+    return ret
+
+
+def bugs_convert_iter(bugs, comments_path):
+    # Yield (new_id, new_issue) in destination order, while up to
+    # 2 * convert_workers issues are being converted in the background
+    with ThreadPoolExecutor(max_workers=convert_workers) as executor:
+        pending = deque()
+        for bug in bugs:
+            pending.append(executor.submit(
+                bug_convert_sampled if profile_dir else bug_convert,
+                bug, comments_path))
+            if len(pending) < 2 * convert_workers:
+                continue
+            new_issue = pending.popleft().result()
+            yield new_issue.pop("number"), new_issue
+        while pending:
+            new_issue = pending.popleft().result()
+            yield new_issue.pop("number"), new_issue
+
+
+def placeholder_issue(src_number):
+    return {"src_number": src_number,
+            "placeholder": True,
+            "title": "Placeholder for %s#%d" % (src_prefix_issues, src_number),
+            "body": "%s\n\nThis issue was created by %s to keep the "
+                    "numbering of the original issues."
+                    % (src_number_line(src_number),
+                       os.path.basename(__file__)),
+            "closed": True,
+            "labels": [],
+            "comments": []}
+
+
+def gaps_fill(items):
+    # With -g, insert placeholders for the numbers of the pull requests
+    # (and the missing issues), so that the numbers are kept
+    if not preserve_numbers:
+        yield from items
+        return
+    next_id = existing_issues + 1
+    for new_id, issue in items:
+        while next_id < new_id:
+            yield next_id, placeholder_issue(next_id - existing_issues)
+            next_id += 1
+        yield new_id, issue
+        next_id = new_id + 1
+
+
+def bugs_convert_queue(bugs, comments_path):
+    # Convert the issues in a separate thread, so that the first import
+    # can be sent as soon as the first issue is converted
+    converted = queue.Queue(maxsize=queue_size)
+
+    def produce():
+        try:
+            for item in bugs_convert_iter(bugs, comments_path):
+                converted.put(item)
+            converted.put(None)
+        except BaseException as e:
+            converted.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = converted.get()
+        if item is None:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def token_pool_init():
+    del token_pool[:]
+    for token in [github_token] + github_read_tokens:
+        token_pool.append({"token": token, "remaining": None, "reset": 0})
+
+
+def token_acquire():
+    # Pick the token with the largest known budget (unknown = unused yet)
+    with token_lock:
+        while True:
+            now = time.time()
+            available = [entry for entry in token_pool
+                         if entry["remaining"] is None
+                         or entry["remaining"] > 0 or entry["reset"] <= now]
+            if available:
+                entry = max(available,
+                            key=lambda e: (e["remaining"] is None,
+                                           e["remaining"] or 0))
+                if entry["remaining"]:
+                    entry["remaining"] -= 1
+                return entry
+            wait = min(entry["reset"] for entry in token_pool) - now + 1
+            print("Rate limit exceeded for all tokens, waiting %d seconds..."
+                  % wait)
+            time.sleep(wait)
+
+
+def token_update(entry, r):
+    remaining = r.headers.get("X-RateLimit-Remaining")
+    reset = r.headers.get("X-RateLimit-Reset")
+    if remaining is None or reset is None:
+        return
+    with token_lock:
+        entry["remaining"] = int(remaining)
+        entry["reset"] = int(reset)
+
+
+def github_api_url(url):
     if url[0] == "/":
-        u = "%s%s" % (github_url, url)
+        return "%s%s" % (github_url, url)
     elif url.startswith("https://"):
-        u = url
+        return url
     elif url.startswith("http://"):
-        u = url
+        return url
     else:
-        u = "%s/repos/%s/%s/%s" % (github_url, github_owner, github_repo, url)
+        return "%s/repos/%s/%s/%s" % (github_url, github_owner, github_repo,
+                                      url)
+
+
+def github_get(url, avs={}):
+    import requests
+    u = github_api_url(url)
 
     if debug:
         print("GET: " + u)
 
-    avs["access_token"] = github_token
-    return requests.get(u, params=avs)
+    entry = token_acquire()
+    params = dict(avs, access_token=entry["token"])
+    r = requests.get(u, params=params)
+    token_update(entry, r)
+    return r
 
 
-def github_post(url, avs={}, fields=[]):
-    if url[0] == "/":
-        u = "%s%s" % (github_url, url)
-    else:
-        u = "%s/repos/%s/%s/%s" % (github_url, github_owner, github_repo, url)
+def github_get_many(urls, avs_list=None):
+    # Run independent GET requests concurrently, one thread per token
+    if avs_list is None:
+        avs_list = [{} for url in urls]
+    with ThreadPoolExecutor(max_workers=len(token_pool)) as executor:
+        return list(executor.map(github_get, urls, avs_list))
 
-    d = {}
-    # Copy fields into the data
-    for field in fields:
-        if field not in avs:
-            print("Error posting filed %s to %s" % (field, url))
-            exit(1)
-        d[field] = avs[field]
+
+def github_list(url, avs={}, page=0):
+    # Yield (page number, items) for each listing page after the given one,
+    # fetching as many pages at once as there are tokens
+    while True:
+        pages = list(range(page + 1, page + 1 + len(token_pool)))
+        found = github_get_many([url] * len(pages),
+                                [dict(avs, per_page=100, page=page)
+                                 for page in pages])
+        for page, r in zip(pages, found):
+            if not r:
+                print("Error listing %s (page %d): %s" % (url, page, r.headers))
+                exit(1)
+            items = r.json()
+            yield page, items
+            if len(items) < 100:
+                return
+
+
+def github_write(method, url, d):
+    # Send a POST or PATCH request, only with -f
+    import requests
+    u = github_api_url(url)
 
     if debug:
-        print("POST: " + u)
+        print("%s: %s" % (method, u))
         print("DATA: " + json.dumps(d))
 
     if force_update:
-        return requests.post(u, params={"access_token": github_token},
+        r = requests.request(method, u, params={"access_token": github_token},
                              data=json.dumps(d))
+        token_update(token_pool[0], r)
+        return r
     else:
-        if not github_post.warn:
-            print("Skipping POST... (use -f to force updates)")
-            github_post.warn = True
+        if not github_write.warn:
+            print("Skipping %s... (use -f to force updates)" % method)
+            github_write.warn = True
         return True
 
 
-github_post.warn = False
+github_write.warn = False
+
+
+def github_post(url, avs={}, fields=[]):
+    d = {}
+    # Copy fields into the data
+    for field in fields:
+        if field not in avs:
+            print("Error posting filed %s to %s" % (field, url))
+            exit(1)
+        d[field] = avs[field]
+    return github_write("POST", url, d)
+
+
+def github_patch(url, avs={}):
+    return github_write("PATCH", url, avs)
 
 
 def github_label_create(label):
@@ -371,8 +1021,10 @@ def github_labels_check(issues):
         for label in issues[id]["labels"]:
             labels_set.add(label)
 
-    for label in labels_set:
-        if github_get("labels/" + label):
+    labels = sorted(labels_set)
+    found = github_get_many(["labels/" + label for label in labels])
+    for label, r in zip(labels, found):
+        if r:
             print("\tlabel '%s' exists on GitHub" % label)
         else:
             if force_update:
@@ -387,8 +1039,10 @@ def github_assignees_check(issues):
         if "assignee" in issues[id]:
             a_set.add(issues[id]["assignee"])
 
-    for assignee in a_set:
-        if not github_get("/users/" + assignee):
+    assignees = sorted(a_set)
+    found = github_get_many(["/users/" + assignee for assignee in assignees])
+    for assignee, r in zip(assignees, found):
+        if not r:
             print("Error checking user '%s' on GitHub" % assignee)
             exit(1)
         else:
@@ -411,47 +1065,223 @@ def github_issue_get(number):
     return req.json()
 
 
-def github_issue_append(new_id, issue):
-    params = {"access_token": github_token}
-    headers = {"Accept": "application/vnd.github.golden-comet-preview+json"}
+def issue_payload(issue):
+    # Serialize the issue as expected by the import API
     src_id = issue.pop("src_number", 0)
-    print("\timporting %s#%d to #%d on GitHub..."
-          % (src_prefix_issues, src_id, new_id))
-    u = ("https://api.github.com/repos/%s/%s/import/issues"
-         % (github_owner, github_repo))
+    issue.pop("placeholder", None)
     comments = issue.pop("comments", [])
     # We can't assign people which are not in the organization / collaborators on the repo
     if github_owner != "ProofGeneral":  #FIXME/WARN: this test may be removed
         issue.pop("assignee", None)
-    r = requests.post(u, params=params, headers=headers,
-                      data=json.dumps({"issue": issue, "comments": comments}))
+    return src_id, json.dumps({"issue": issue, "comments": comments})
+
+
+def payload_repair_body(payload):
+    changed = False
+    for obj in [payload["issue"]] + payload["comments"]:
+        if len(obj["body"]) > max_body_length:
+            note = "\n\n[truncated by %s]" % os.path.basename(__file__)
+            obj["body"] = obj["body"][:max_body_length - len(note)] + note
+            changed = True
+    return changed
+
+
+def payload_repair_comments(payload):
+    comments = payload["comments"]
+    if len(comments) <= max_comments:
+        return False
+    dropped = len(comments) - max_comments + 1
+    payload["comments"] = comments[:max_comments - 1]
+    payload["comments"].append({
+        "body": "%d more comments were not imported by %s"
+                % (dropped, os.path.basename(__file__)),
+        "created_at": comments[-1]["created_at"]})
+    return True
+
+
+def payload_repair_assignee(payload):
+    return payload["issue"].pop("assignee", None) is not None
+
+
+payload_repair_functions = {
+    "body": payload_repair_body,
+    "comments": payload_repair_comments,
+    "assignee": payload_repair_assignee,
+}
+
+
+def payload_repair(data, repairs):
+    # Apply the first repair (popped from repairs) that changes the payload
+    payload = json.loads(data)
+    while repairs:
+        repair = repairs.pop(0)
+        if payload_repair_functions[repair](payload):
+            print("\trepairing the payload (%s)..." % repair)
+            return json.dumps(payload)
+    return None
+
+
+def import_error_kind(r):
+    # Classify a failed import request: "transient", "rate-limit",
+    # "payload" (the payload was rejected) or "fatal"
+    if r is None or r.status_code >= 500:
+        return "transient"
+    if r.status_code in [403, 429] and (
+            r.headers.get("X-RateLimit-Remaining") == "0"
+            or "Retry-After" in r.headers
+            or "rate limit" in r.text.lower()):
+        return "rate-limit"
+    if r.status_code in [400, 413, 422]:
+        return "payload"
+    return "fatal"
+
+
+def import_error_wait(kind, r, attempt):
+    if kind == "rate-limit":
+        if "Retry-After" in r.headers:
+            return int(r.headers["Retry-After"])
+        if "X-RateLimit-Reset" in r.headers:
+            return max(int(r.headers["X-RateLimit-Reset"]) - time.time(), 0) + 1
+        return 60
+    return 2 ** attempt
+
+
+def github_import_post(data):
+    # Return (None, response) if the import was queued,
+    # (error kind, response or None) otherwise
+    import requests
+    params = {"access_token": github_token}
+    headers = {"Accept": "application/vnd.github.golden-comet-preview+json"}
+    u = ("%s/repos/%s/%s/import/issues"
+         % (github_url, github_owner, github_repo))
+    try:
+        r = requests.post(u, params=params, headers=headers, data=data)
+    except requests.exceptions.RequestException as e:
+        print("Error importing issue on GitHub:\n%s" % e)
+        return "transient", None
+    token_update(token_pool[0], r)
     if not r:
         print("Error importing issue on GitHub:\n%s" % r.text)
-        print("For the record, here was the request:\n%s"
-              % json.dumps({"issue": issue, "comments": comments}))
-        exit(1)
-    u = r.json()["url"]
+        return import_error_kind(r), r
+    return None, r
+
+
+def github_imports_wait(rs):
+    # Wait for the end of the queued imports: they are all polled right
+    # away, then again with an increasing delay while some are pending.
+    # Return the list of (None or error kind, response or None)
+    import requests
+    params = {"access_token": github_token}
+    headers = {"Accept": "application/vnd.github.golden-comet-preview+json"}
+    urls = [r.json()["url"] for r in rs]
+    ret = [None] * len(rs)
+    failures = [0] * len(rs)
     wait = 1
-    r = False
-    while not r or r.json()["status"] == "pending":
+    while True:
+        for i, u in enumerate(urls):
+            if ret[i] is not None:
+                continue
+            try:
+                r = requests.get(u, params=params, headers=headers)
+            except requests.exceptions.RequestException:
+                r = None
+            if not r:
+                failures[i] += 1
+                if failures[i] > max_retries:
+                    print("Error getting the import status on GitHub")
+                    ret[i] = ("transient", r)
+            elif r.json()["status"] == "imported":
+                ret[i] = (None, r)
+            elif r.json()["status"] != "pending":
+                print("Error importing issue on GitHub:\n%s" % r.text)
+                ret[i] = ("payload", r)
+        if None not in ret:
+            return ret
         time.sleep(wait)
-        wait = 2 * wait
-        r = requests.get(u, params=params, headers=headers)
-    if not r.json()["status"] == "imported":
-        print("Error importing issue on GitHub:\n%s" % r.text)
-        exit(1)
+        wait = min(2 * wait, max_poll_wait)
+
+
+def github_issue_import(data):
+    # Return (None, response) if the issue was imported,
+    # (error kind, response or None) otherwise
+    kind, r = github_import_post(data)
+    if kind is not None:
+        return kind, r
+    return github_imports_wait([r])[0]
+
+
+def github_issue_number(new_id, src_id, r):
     # The issue_url field of the answer should be of the form .../ISSUE_NUMBER
     # So it's easy to get the issue number, to check that it is what was expected
-    result = re.match("https://api.github.com/repos/"
+    result = re.match(github_url + "/repos/"
                       + github_owner + "/" + github_repo
-                      + "/issues/(\d+)", r.json()["issue_url"])
+                      + r"/issues/(\d+)", r.json()["issue_url"])
     if not result:
         print("Error while parsing issue number:\n%s" % r.text)
     issue_number = result.group(1)
-    if str(new_id) != issue_number:
+    if new_id is not None and str(new_id) != issue_number:
         print("Error while comparing created id #%s and expected id #%d (for src_id #%d)"
               % (issue_number, new_id, src_id))
-    with open("json2github.log", "a") as f:
+    return issue_number
+
+
+def github_issue_created(number):
+    # After a transient error, the import may still be queued on GitHub:
+    # wait for the issue for a while before resubmitting it
+    wait = 1
+    for check in range(created_checks):
+        if github_issue_exist(number):
+            return True
+        time.sleep(wait)
+        wait = min(2 * wait, max_poll_wait)
+    return github_issue_exist(number)
+
+
+def github_issue_send(new_id, src_id, data, placeholder=False):
+    print("\timporting %s#%d to #%d on GitHub..."
+          % (src_prefix_issues, src_id, new_id))
+    attempt = 0
+    repairs = list(payload_repairs)
+    while True:
+        kind, r = github_issue_import(data)
+        if kind is None:
+            issue_number = github_issue_number(new_id, src_id, r)
+            break
+        if kind == "payload" and repairs:
+            repaired = payload_repair(data, repairs)
+            if repaired:
+                data = repaired
+                continue
+        elif kind in ["transient", "rate-limit"] and attempt < max_retries:
+            # The issue may have been created despite the error
+            if kind == "transient" and github_issue_created(new_id):
+                print("\tissue #%d was created anyway" % new_id)
+                issue_number = str(new_id)
+                break
+            attempt += 1
+            wait = import_error_wait(kind, r, attempt)
+            print("\tretrying in %d seconds (%s error, attempt %d/%d)..."
+                  % (wait, kind, attempt, max_retries))
+            time.sleep(wait)
+            continue
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        print("For the record, here was the request:\n%s" % data)
+        if not keep_going or placeholder:
+            exit(1)
+        # Keep the numbering by importing a placeholder instead
+        print("\timporting a placeholder for %s#%d (see %s)..."
+              % (src_prefix_issues, src_id, failed_log))
+        with open(failed_log, "a") as f:
+            f.write("%d, %d, %s\n" % (src_id, new_id, kind))
+        return github_issue_send(new_id, src_id, json.dumps({
+            "issue": {"title": "Issue %s#%d could not be imported"
+                               % (src_prefix_issues, src_id),
+                      "body": "%s\n\nSee %s" % (src_number_line(src_id),
+                                                 failed_log),
+                      "closed": True},
+            "comments": []}), True)
+    with open_any(import_log, "a") as f:
         f.write("%d, %s\n" % (src_id, issue_number))
     return issue_number
 
@@ -485,51 +1315,505 @@ def github_issue_append(new_id, issue):
 #                 print("Creating issue #%d..." % id)
 #                 github_issue_append(todo_id, issue)
 
-def github_issues_add(issues):
-    id = existing_issues
-    while True:
-        id += 1
-        if github_get("issues/%d" % id):
-            if id in issues:
-                print("Issue #%d already exists, skipping..." % id)
-        else:
-            if id in issues:
-                issue = issues.pop(id)
-            else:
-                if len(issues) == 0:
-                    print("===> All done.")
-                    exit(0)
+def github_placeholders_send(batch):
+    # Import a batch of (new_id, src_id, data) placeholders: all the imports
+    # are queued before waiting for them. GitHub may process them in any
+    # order, so the log records the number each one actually got.
+    queued = []
+    for new_id, src_id, data in batch:
+        print("\timporting placeholder for %s#%d to #%d on GitHub..."
+              % (src_prefix_issues, src_id, new_id))
+        kind, r = github_import_post(data)
+        if kind is not None:
+            break
+        queued.append((src_id, r))
+    remaining = [(src_id, data) for new_id, src_id, data in batch]
+    new_id = batch[0][0]
+    results = github_imports_wait([r for src_id, r in queued])
+    for (src_id, _), (kind, r) in zip(queued, results):
+        if kind is not None:
+            continue
+        issue_number = github_issue_number(None, src_id, r)
+        remaining = [item for item in remaining if item[0] != src_id]
+        with open_any(import_log, "a") as f:
+            f.write("%d, %s\n" % (src_id, issue_number))
+        new_id += 1
+    # Import the remaining ones one at a time, with retries
+    for src_id, data in remaining:
+        github_issue_send(new_id, src_id, data)
+        new_id += 1
+
+
+def github_issues_add(items, last_issue, serialize=issue_payload):
+    # Import the (new_id, issue) items, given in increasing new_id order,
+    # after the issue #last_issue; the placeholders are sent by batches
+    id = last_issue
+    batch = []
+    for new_id, issue in items:
+        if new_id <= last_issue:
+            continue
+        while id < new_id:
+            id += 1
+            exists = github_get("issues/%d" % id)
+            if not exists and id < new_id:
+                print("Error: No pending issues found.")
+                exit(1)
+        if exists:
+            print("Issue #%d already exists, skipping..." % id)
+        elif force_update and issue.get("placeholder"):
+            batch.append((id,) + serialize(issue))
+            if len(batch) >= placeholders_batch:
+                github_placeholders_send(batch)
+                batch = []
+        elif force_update:
+            if batch:
+                github_placeholders_send(batch)
+                batch = []
+            print("Creating issue #%d..." % id)
+            github_issue_send(id, *serialize(issue))
+    if batch:
+        github_placeholders_send(batch)
+    print("===> All done.")
+
+
+def issue_digest(title, body, labels, closed, comments):
+    content = json.dumps([title, body or "", sorted(labels), closed, comments])
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def issue_fields(issue):
+    # Fields of a locally converted issue that are compared with GitHub
+    return {"title": issue["title"],
+            "body": issue["body"],
+            "labels": sorted(issue["labels"]),
+            "closed": issue["closed"],
+            "comments": len(issue["comments"])}
+
+
+def github_issue_fields(github_issue):
+    return {"title": github_issue["title"],
+            "body": github_issue["body"] or "",
+            "labels": sorted(extract_labels(github_issue["labels"])),
+            "closed": github_issue["state"] == "closed",
+            "comments": github_issue["comments"]}
+
+
+def issue_mismatch(issue, github_issue):
+    local = issue_fields(issue)
+    remote = github_issue_fields(github_issue)
+    if issue_digest(**local) == issue_digest(**remote):
+        return []
+    return [field for field in local if local[field] != remote[field]]
+
+
+def verify_resume():
+    # The verification log has one line per checked issue:
+    # destination issue number, status
+    # and one line per listed page: page, page number, last issue number.
+    # Return the checked issues and the page to resume the listing after
+    checked = {}
+    page = 0
+    last_number = None
+    try:
+        with open(verify_log, "r") as f:
+            for row in csv.reader(f):
+                if row[0] == "page":
+                    page, last_number = int(row[1]), int(row[2])
                 else:
-                    print("Error: No pending issues found.")
-                    exit(1)
-            if force_update:
-                print("Creating issue #%d..." % id)
-                github_issue_append(id, issue)
+                    checked[int(row[0])] = row[1].strip()
+    except IOError:
+        return checked, 0
+    print("===> Resuming verification (%d issues already checked)"
+          % len(checked))
+    # The imported issues keep their original creation date, so a page
+    # lists the same issues as long as none was added or deleted before it
+    if page:
+        r = github_get("issues", {"state": "all", "sort": "created",
+                                  "direction": "asc", "per_page": 100,
+                                  "page": page})
+        if not r or not r.json() or r.json()[-1]["number"] != last_number:
+            print("The issues changed on GitHub, listing all of them again")
+            page = 0
+    return checked, page
+
+
+def github_issues_verify(bugs):
+    checked, page = verify_resume()
+    # Only the issues not checked yet are converted
+    issues = {}
+    for new_id, issue in gaps_fill(bugs_convert_iter(
+            [bug for bug in bugs if src_index[bug["number"]] not in checked],
+            comments_path)):
+        if new_id not in checked:
+            issues[new_id] = issue
+
+    for page, github_issues in github_list("issues", {"state": "all",
+                                                      "sort": "created",
+                                                      "direction": "asc"},
+                                           page):
+        rows = []
+        for github_issue in github_issues:
+            number = github_issue["number"]
+            if ("pull_request" in github_issue or number not in issues
+                    or number in checked):
+                continue
+            fields = issue_mismatch(issues[number], github_issue)
+            if fields:
+                status = "mismatch " + " ".join(fields)
+            else:
+                status = "ok"
+            checked[number] = status
+            rows.append("%d, %s\n" % (number, status))
+        print("\tpage %d: %d issues checked" % (page, len(rows)))
+        # The last page may still grow
+        if len(github_issues) == 100:
+            rows.append("page, %d, %d\n"
+                        % (page, github_issues[-1]["number"]))
+        with open(verify_log, "a") as f:
+            f.writelines(rows)
+
+    print("===> Verification report:")
+    mismatches = 0
+    missing = 0
+    numbers = set(issues) | set(checked)
+    src_numbers = dict((new_id, src_id) for src_id, new_id in src_index.items())
+    for number in sorted(numbers):
+        status = checked.get(number, "missing")
+        if status == "ok":
+            continue
+        if status == "missing":
+            missing += 1
+        else:
+            mismatches += 1
+        if number in issues:
+            src_number = issues[number]["src_number"]
+        else:
+            # The placeholders of -g keep the source numbers
+            src_number = src_numbers.get(number, number - existing_issues)
+        print("\t%s#%d (#%d on GitHub): %s"
+              % (src_prefix_issues, src_number, number, status))
+    print("%d issues, %d mismatches, %d missing"
+          % (len(numbers), mismatches, missing))
+    if mismatches or missing:
+        exit(1)
+
+
+def github_issues_recover():
+    # Rebuild the log from the source numbers found in the imported issues
+    logged = set()
+    try:
+        for row in import_log_rows():
+            logged.add(int(row[1]))
+    except IOError:
+        pass
+
+    found = {}
+    for page, github_issues in github_list("issues", {"state": "all",
+                                                      "sort": "created",
+                                                      "direction": "asc"}):
+        for github_issue in github_issues:
+            if "pull_request" in github_issue:
+                continue
+            src_id = src_number_extract(github_issue["body"])
+            if src_id is not None:
+                found[github_issue["number"]] = src_id
+        print("\tpage %d: %d imported issues found so far" % (page, len(found)))
+
+    with open_any(import_log, "a") as f:
+        for number in sorted(set(found) - logged):
+            f.write("%d, %d\n" % (found[number], number))
+    print("%d imported issues found, %d added to %s"
+          % (len(found), len(set(found) - logged), import_log))
+
+
+def import_log_rows():
+    # Return the rows of the import log; a compressed log cut short (e.g.
+    # when the script was killed while writing it) raises EOFError and
+    # couldn't be appended to: it is rewritten without its last row
+    rows = []
+    try:
+        with open_any(import_log, "r") as f:
+            for row in csv.reader(f):
+                rows.append(row)
+    except EOFError:
+        rows = rows[:-1]
+        print("WARNING: %s is truncated, keeping its first %d lines"
+              % (import_log, len(rows)))
+        root, ext = os.path.splitext(import_log)
+        with open_any(root + ".tmp" + ext, "w") as f:
+            for row in rows:
+                f.write(",".join(row) + "\n")
+        os.replace(root + ".tmp" + ext, import_log)
+    return rows
+
+
+def import_log_read():
+    # Map the source issue numbers to the imported ones
+    links = {}
+    for row in import_log_rows():
+        links[int(row[0])] = int(row[1])
+    return links
+
+
+def github_comments_index():
+    # Map the IDs of the source comments to the IDs of the imported ones;
+    # as the comments of an issue are imported in order, their IDs are
+    # increasing, so they can be matched by position
+    import dbm
+    try:
+        links = import_log_read()
+    except IOError:
+        print("ERROR: no log of the imported issues (%s)" % import_log)
+        exit(1)
+    imported = {}
+    for page, comments in github_list("issues/comments",
+                                      {"sort": "created",
+                                       "direction": "asc"}):
+        for comment in comments:
+            number = int(comment["issue_url"].rsplit("/", 1)[1])
+            imported.setdefault(number, []).append(comment["id"])
+        print("\tpage %d: %d comments" % (page, len(comments)))
+
+    count = 0
+    with dbm.open(comments_index, "c") as index:
+        for src_id, number in sorted(links.items()):
+            # No comments file, e.g. for the placeholders
+            filename = comments_file(src_id)
+            if filename is None:
+                continue
+            try:
+                with open_any(filename, "r") as json_data:
+                    src_comments = json.load(json_data)
+            except IOError:
+                continue
+            if not isinstance(src_comments, list):
+                src_comments = [src_comments]
+            dst_comments = sorted(imported.get(number, []))
+            if len(src_comments) != len(dst_comments):
+                print("WARNING: %d comments for %s#%d but %d for #%d"
+                      % (len(src_comments), src_prefix_issues, src_id,
+                         len(dst_comments), number))
+            for src_comment, dst_id in zip(src_comments, dst_comments):
+                index[str(src_comment["id"])] = "%d %d" % (number, dst_id)
+                count += 1
+    print("%d comments indexed in %s" % (count, comments_index))
+
+
+def github_body_edit(url, body):
+    # Edit the body of an issue or a comment, with retries
+    import requests
+    attempt = 0
+    while True:
+        try:
+            r = github_patch(url, {"body": body})
+        except requests.exceptions.RequestException as e:
+            print("Error editing %s: %s" % (url, e))
+            r = None
+        if r:
+            return
+        kind = import_error_kind(r)
+        if kind in ["transient", "rate-limit"] and attempt < max_retries:
+            attempt += 1
+            wait = import_error_wait(kind, r, attempt)
+            print("\tretrying in %d seconds (%s error, attempt %d/%d)..."
+                  % (wait, kind, attempt, max_retries))
+            time.sleep(wait)
+            continue
+        if r is not None:
+            print("Error editing %s: %s" % (url, r.text))
+        exit(1)
+
+
+def github_issues_relink():
+    # Rewrite the links to the source comments in the imported issues and
+    # comments, one edit at a time
+    global comment_links, issue_links
+    import dbm
+    try:
+        comment_links = dbm.open(comments_index, "r")
+    except dbm.error:
+        print("ERROR: no index of the comments (%s), see the index command"
+              % comments_index)
+        exit(1)
+    try:
+        issue_links = import_log_read()
+    except IOError:
+        print("ERROR: no log of the imported issues (%s)" % import_log)
+        exit(1)
+    edits = 0
+    with comment_links:
+        for url in ["issues", "issues/comments"]:
+            for page, objs in github_list(url, {"state": "all",
+                                                "sort": "created",
+                                                "direction": "asc"}):
+                page_edits = 0
+                for obj in objs:
+                    body = subst_issuecomment(obj["body"])
+                    if body != (obj["body"] or ""):
+                        if url == "issues":
+                            github_body_edit("issues/%d" % obj["number"],
+                                             body)
+                        else:
+                            github_body_edit("issues/comments/%d" % obj["id"],
+                                             body)
+                        page_edits += 1
+                edits += page_edits
+                print("\t%s page %d: %d links %s"
+                      % (url, page, page_edits,
+                         "rewritten" if force_update else "to rewrite"))
+    comment_links = {}
+    print("%d issues and comments %s"
+          % (edits, "rewritten" if force_update else "would be rewritten"))
+
+
+def validate_init(settings):
+    # Initialize a validation process with the settings of the main one
+    globals().update(settings)
+
+
+def bugs_validate(bugs):
+    global warnings_report
+    warnings_report = {}
+    for bug in bugs:
+        src_number = bug.get("number")
+        try:
+            issue = bug_convert(bug, comments_path)
+        except Exception as e:
+            warning("conversion error", "%s: %s" % (type(e).__name__, e), "")
+            continue
+        if len(issue["body"]) > max_body_length:
+            warning("body too long", src_number, "")
+        if len(issue["comments"]) > max_comments:
+            warning("too many comments", src_number, "")
+        for comment in issue["comments"]:
+            if len(comment["body"]) > max_body_length:
+                warning("comment too long", src_number, "")
+    return warnings_report
+
+
+def issues_validate(bugs):
+    # Convert the issues by shards in validate_workers processes, with the
+    # comments folder scanned once
+    from concurrent.futures import ProcessPoolExecutor
+    try:
+        files = set(entry.name for entry in os.scandir(comments_path))
+    except OSError as e:
+        print("ERROR: cannot read the comments folder: %s" % e)
+        exit(2)
+    settings = {"src_issues": src_issues, "src_index": src_index,
+                "existing_issues": existing_issues,
+                "preserve_numbers": preserve_numbers,
+                "src_prefix_issues": src_prefix_issues,
+                "comments_path": comments_path, "comment_files": files,
+                "labels_to_add": labels_to_add, "asset_base_url": ""}
+    shard_size = max(1, len(bugs) // (validate_workers * 4) + 1)
+    shards = [bugs[i:i + shard_size] for i in range(0, len(bugs), shard_size)]
+    report = {}
+    with ProcessPoolExecutor(max_workers=validate_workers,
+                             initializer=validate_init,
+                             initargs=(settings,)) as executor:
+        for shard_report in executor.map(bugs_validate, shards):
+            for kind, details in shard_report.items():
+                total = report.setdefault(kind, {})
+                for detail, count in details.items():
+                    total[detail] = total.get(detail, 0) + count
+
+    print("===> Validation report (%d issues, %d shards):"
+          % (len(bugs), len(shards)))
+    if not report:
+        print("\tno warning")
+        return
+    for kind in sorted(report):
+        details = report[kind]
+        print("\t%s: %d (%d distinct)"
+              % (kind, sum(details.values()), len(details)))
+        for detail in sorted(details, key=details.get, reverse=True)[:10]:
+            print("\t\t%s (x%d)" % (detail, details[detail]))
+    exit(1)
+
+
+def manifest_file():
+    return payload_file + ".manifest"
+
+
+def payloads_write(items):
+    # One import payload per line, in destination order; the manifest
+    # gives its location along with what is needed for the preflight checks
+    count = 0
+    offset = 0
+    with open_any(payload_file, "wb") as payloads, \
+            open(manifest_file(), "w") as manifest:
+        writer = csv.writer(manifest)
+        for new_id, issue in items:
+            labels = issue["labels"]
+            kind = "placeholder" if issue.get("placeholder") else "issue"
+            src_id, data = issue_payload(issue)
+            data = data.encode("utf-8") + b"\n"
+            payloads.write(data)
+            writer.writerow([src_id, new_id, offset, len(data), kind,
+                             issue.get("assignee", "")] + labels)
+            offset += len(data)
+            count += 1
+    print("%d issues written to %s (manifest: %s)"
+          % (count, payload_file, manifest_file()))
+
+
+def manifest_read():
+    entries = {}
+    with open(manifest_file(), "r") as manifest:
+        for row in csv.reader(manifest):
+            entry = {"src_number": int(row[0]),
+                     "offset": int(row[2]),
+                     "length": int(row[3]),
+                     "placeholder": row[4] == "placeholder",
+                     "labels": row[6:]}
+            if row[5]:
+                entry["assignee"] = row[5]
+            entries[int(row[1])] = entry
+    return entries
+
+
+def payload_read(payloads, entry):
+    payloads.seek(entry["offset"])
+    return payloads.read(entry["length"])
 
 
 def args_parse(argv):
-    global force_update
-    global github_owner, github_repo, github_token
+    global command, force_update, assume_yes
+    global github_owner, github_repo, github_token, github_read_tokens
     global json_file, comments_path, existing_issues, src_prefix_issues
+    global payload_file, convert_workers, validate_workers
+    global max_retries, keep_going
+    global asset_base_url, asset_store, preserve_numbers, placeholders_batch
+    global profile_dir, profile_sampling, trace_frames
+    global import_log, compress_ext
 
     try:
-        opts, args = getopt.getopt(argv, "hfo:r:t:j:c:i:p:")
+        opts, args = getopt.gnu_getopt(argv, "hfykgo:r:t:T:j:c:i:p:P:w:n:x:a:A:b:C:S:M:z:")
     except getopt.GetoptError:
         usage()
+    if len(args) > 1 or (args and args[0] not in ["import", "verify",
+                                                  "convert", "upload",
+                                                  "recover", "index",
+                                                  "relink", "validate"]):
+        usage()
+    if args:
+        command = args[0]
     for opt, arg in opts:
         if opt == '-h':
             usage()
         elif opt == "-f":
-            print("WARNING: the repo will be UPDATED! No backups, no undos!")
-            print("Press Ctrl+C within next 5 seconds to cancel the update:")
-            time.sleep(5)
             force_update = True
+        elif opt == "-y":
+            assume_yes = True
         elif opt == "-o":
             github_owner = arg
         elif opt == "-r":
             github_repo = arg
         elif opt == "-t":
             github_token = arg
+        elif opt == "-T":
+            github_read_tokens.extend(arg.split(","))
         elif opt == "-j":
             json_file = arg
         elif opt == "-c":
@@ -538,74 +1822,196 @@ def args_parse(argv):
             existing_issues = int(arg)
         elif opt == "-p":
             src_prefix_issues = arg
+        elif opt == "-P":
+            payload_file = arg
+        elif opt == "-w":
+            convert_workers = int(arg)
+        elif opt == "-n":
+            validate_workers = int(arg)
+        elif opt == "-x":
+            max_retries = int(arg)
+        elif opt == "-k":
+            keep_going = True
+        elif opt == "-g":
+            preserve_numbers = True
+        elif opt == "-b":
+            placeholders_batch = int(arg)
+        elif opt == "-z":
+            compress_ext = "." + arg.lstrip(".")
+            if compress_ext not in compressed_exts:
+                usage()
+        elif opt == "-C":
+            profile_dir = arg
+        elif opt == "-S":
+            profile_sampling = int(arg)
+        elif opt == "-M":
+            trace_frames = int(arg)
+        elif opt == "-a":
+            asset_base_url = arg
+        elif opt == "-A":
+            asset_store = arg
+
+    if force_update:
+        print("WARNING: the repo will be UPDATED! No backups, no undos!")
+        if not assume_yes:
+            print("Press Ctrl+C within next 5 seconds to cancel the update:")
+            time.sleep(5)
+    if compress_ext:
+        import_log += compress_ext
+        if not payload_file.endswith(compress_ext):
+            payload_file += compress_ext
 
     # Check the arguments
-    if (not (json_file and comments_path and
-             github_owner and github_repo and github_token)):
+    if (command not in ["upload", "recover", "index", "relink"] and
+            not (json_file and comments_path)):
         print("Missing argument(s):\n  "
-              "please specify JSON file, comments path, "
-              "GitHub owner, repo and token.\n")
+              "please specify JSON file and comments path.\n")
         usage()
+    if command == "index" and not comments_path:
+        print("Missing argument(s):\n  please specify comments path.\n")
+        usage()
+    if command == "relink" and not src_prefix_issues:
+        print("Missing argument(s):\n  please specify source repo.\n")
+        usage()
+    if (command not in ["convert", "validate"] and
+            not (github_owner and github_repo and github_token)):
+        print("Missing argument(s):\n  "
+              "please specify GitHub owner, repo and token.\n")
+        usage()
+    # The payloads depend on the owner, see issue_payload()
+    if command == "convert" and not github_owner:
+        print("Missing argument(s):\n  please specify GitHub owner.\n")
+        usage()
+    token_pool_init()
 
 
-def main(argv):
-    global existing_issues
-    # Parse command line arguments
-    args_parse(argv)
-    print("===> Importing JSON data to GitHub Issues...")
-    print("\tSource JSON file:   %s" % json_file)
-    print("\tSrc. comments dir.:  %s" % comments_path)
-    print("\tDest. GitHub owner: %s" % github_owner)
-    print("\tDest. GitHub repo:  %s" % github_repo)
-
-    with open(json_file) as json_data:
-        src_issues_json = json.load(json_data)
-
-    issues = bugs_convert(src_issues_json, comments_path)
-
+def import_resume():
+    # Return the last issue number on GitHub and the source numbers of the
+    # issues already imported
+    last_issue = existing_issues
+    imported = set()
     try:
-        with open("json2github.log", "r") as f:
-            print("===> Skipping already imported issues\n"
-                  "(WARNING: this shouldn't happen when you run this script "
-                  "for the first time)...")
+        imported_bugs = import_log_rows()
+        print("===> Skipping already imported issues\n"
+              "(WARNING: this shouldn't happen when you run this script "
+              "for the first time)...")
+        if not assume_yes:
             time.sleep(5)
-            imported_bugs = csv.reader(f)
-            for imported_bug in imported_bugs:
-                issues.pop(int(imported_bug[0]), None)
-                existing_issues = max(existing_issues, int(imported_bug[1]))
+        for imported_bug in imported_bugs:
+            imported.add(int(imported_bug[0]))
+            last_issue = max(last_issue, int(imported_bug[1]))
     except IOError:
         print("===> No log file found. Not skipping any issue.")
 
     print("===> Checking last existing issue actually exists.")
-    if not github_issue_exist(existing_issues):
+    if last_issue and not github_issue_exist(last_issue):
         print("Last existing issue doesn't actually exist. Aborting!")
         exit(1)
     print("===> Checking whether the following issue was created but not saved.")
-    github_issue = github_get("issues/%d" % (existing_issues + 1))
+    github_issue = github_get("issues/%d" % (last_issue + 1))
     if github_issue:
-        result = re.search("Original bug ID: BZ#(\d+)",
-                           github_issue.json()["body"])
-        if result:
+        src_id = src_number_extract(github_issue.json()["body"])
+        if src_id is not None:
             print("Indeed, this was the case.")
-            src_id = int(result.group(1))
-            issues.pop(src_id, None)
-            with open("json2github.log", "a") as f:
-                f.write("%d, %d\n" % (src_id, existing_issues + 1))
+            imported.add(src_id)
+            with open_any(import_log, "a") as f:
+                f.write("%d, %d\n" % (src_id, last_issue + 1))
+    return last_issue, imported
 
-    print("===> Checking all the labels exist on GitHub...")
-    github_labels_check(issues)
-    print("===> Checking all the assignees exist on GitHub...")
-    github_assignees_check(issues)
 
-    # fake_issue = {"title": "Fake issue", "body": "Fake issue", "closed": True}
-    # for i in xrange(1,existing_issues + 1):
-    #     github_issue_append(0, fake_issue)
+def main(argv):
+    # Parse command line arguments
+    args_parse(argv)
+    print("===> Importing JSON data to GitHub Issues...")
+    if command == "upload":
+        print("\tSource payload file: %s" % payload_file)
+    elif command not in ["recover", "index", "relink"]:
+        print("\tSource JSON file:   %s" % json_file)
+        print("\tSrc. comments dir.:  %s" % comments_path)
+    if command == "convert":
+        print("\tDest. payload file: %s" % payload_file)
+    elif command != "validate":
+        print("\tDest. GitHub owner: %s" % github_owner)
+        print("\tDest. GitHub repo:  %s" % github_repo)
+    profile_start()
+
+    if command == "recover":
+        print("===> Looking for the imported issues on GitHub...")
+        with profile_phase("recover"):
+            github_issues_recover()
+        return
+
+    if command == "index":
+        print("===> Indexing the imported comments...")
+        with profile_phase("index"):
+            github_comments_index()
+        return
+
+    if command == "relink":
+        print("===> Rewriting the links to the source comments...")
+        with profile_phase("relink"):
+            github_issues_relink()
+        return
+
+    with profile_phase("load"):
+        if command == "upload":
+            issues = manifest_read()
+        else:
+            with open_any(json_file, "r") as json_data:
+                src_issues_json = json.load(json_data)
+            bugs = bugs_prepare(src_issues_json)
+
+    if command == "validate":
+        print("===> Validating the issues...")
+        with profile_phase("validate"):
+            issues_validate(bugs)
+        return
+
+    if command == "convert":
+        print("===> Writing the import payloads...")
+        with profile_phase("convert", conversions=True):
+            payloads_write(gaps_fill(bugs_convert_iter(bugs, comments_path)))
+        profile_convert_save()
+        assets_report()
+        return
+
+    if command == "verify":
+        print("===> Verifying the imported issues on GitHub...")
+        with profile_phase("verify", conversions=True):
+            github_issues_verify(bugs)
+        profile_convert_save()
+        return
+
+    with profile_phase("resume"):
+        last_issue, imported = import_resume()
 
     # if debug:
     #     print("JSON (beware of size): " + json.dumps(issues))
 
+    if command != "upload":
+        issues = bugs_preflight(bugs)
+    print("===> Checking all the labels exist on GitHub...")
+    github_labels_check(issues)
+    print("===> Checking all the assignees exist on GitHub...")
+    github_assignees_check(issues)
+    if command == "upload":
+        items = sorted(issues.items())
+    else:
+        items = gaps_fill(bugs_convert_queue(bugs, comments_path))
+    items = ((new_id, issue) for new_id, issue in items
+             if issue["src_number"] not in imported)
+
     print("===> Adding issues on GitHub...")
-    github_issues_add(issues)
+    with profile_phase("import", conversions=True):
+        if command == "upload":
+            with open_any(payload_file, "rb") as payloads:
+                github_issues_add(items, last_issue,
+                                  lambda entry: (entry["src_number"],
+                                                 payload_read(payloads, entry)))
+        else:
+            github_issues_add(items, last_issue)
+    profile_convert_save()
+    assets_report()
 
 
 if __name__ == "__main__":